@@ -12,16 +12,24 @@
 # language governing permissions and limitations under the License.
 from __future__ import absolute_import
 
+import argparse
+import copy
+import json
 import os
-import sys
+import subprocess
 
-from mock import MagicMock, patch
+from mock import ANY, call, DEFAULT, Mock, patch
 import pytest
 from sagemaker_training import runner
 import tensorflow as tf
 
 from sagemaker_tensorflow_container import training
 
+try:
+    from types import MappingProxyType
+except ImportError:  # Python 2 has no read-only mapping type
+    MappingProxyType = dict
+
 MODULE_DIR = "s3://my/bucket"
 MODULE_NAME = "script_name"
 LOG_LEVEL = "Debug"
@@ -30,23 +38,39 @@ HOST2 = "host2"
 HOST_LIST = [HOST1, HOST2]
 CURRENT_HOST = HOST1
 CMD_ARGS = {"some_key": "some_value"}
-CLUSTER_WITH_PS = {
-    "master": ["{}:2222".format(HOST1)],
-    "worker": ["{}:2222".format(HOST2)],
-    "ps": ["{}:2223".format(HOST1), "{}:2223".format(HOST2)],
-}
+CLUSTER_WITH_PS = MappingProxyType(
+    {
+        "master": ["{}:2222".format(HOST1)],
+        "worker": ["{}:2222".format(HOST2)],
+        "ps": ["{}:2223".format(HOST1), "{}:2223".format(HOST2)],
+    }
+)
 MASTER_TASK = {"index": 0, "type": "master"}
 WORKER_TASK = {"index": 0, "type": "worker"}
 PS_TASK_1 = {"index": 0, "type": "ps"}
 PS_TASK_2 = {"index": 1, "type": "ps"}
+MASTER_TF_CONFIG = {"cluster": dict(CLUSTER_WITH_PS), "environment": "cloud", "task": MASTER_TASK}
+WORKER_TF_CONFIG = {"cluster": dict(CLUSTER_WITH_PS), "environment": "cloud", "task": WORKER_TASK}
 MODEL_DIR = "s3://bucket/prefix"
 MODEL_DIR_CMD_LIST = ["--model_dir", MODEL_DIR]
 REGION = "us-west-2"
 RESOURCE_PATH = os.path.join(os.path.dirname(__file__), "..", "resources")
 
 
+@pytest.fixture(autouse=True)
+def _no_sleep(monkeypatch):
+    monkeypatch.setattr("sagemaker_tensorflow_container.training.time.sleep", lambda *a, **kw: None)
+
+
 @pytest.fixture
-def distributed_training_env():
+def run(monkeypatch):
+    run = Mock()
+    monkeypatch.setattr("sagemaker_training.entry_point.run", run)
+    return run
+
+
+@pytest.fixture(scope="module")
+def _distributed_env_template():
     env = simple_training_env()
 
     env.hosts = HOST_LIST
@@ -54,23 +78,46 @@ def distributed_training_env():
     return env
 
 
+@pytest.fixture
+def distributed_training_env(_distributed_env_template):
+    env = copy.copy(_distributed_env_template)
+    env.additional_framework_parameters = dict(
+        _distributed_env_template.additional_framework_parameters
+    )
+    env.hyperparameters = dict(_distributed_env_template.hyperparameters)
+    return env
+
+
 @pytest.fixture
 def single_machine_training_env():
     return simple_training_env()
 
 
+@pytest.fixture
+def main_mocks(single_machine_training_env):
+    with patch.multiple(
+        "sagemaker_tensorflow_container.training", logger=DEFAULT, train=DEFAULT
+    ) as training_mocks, patch.multiple(
+        "sagemaker_training.environment", Environment=DEFAULT, read_hyperparameters=DEFAULT
+    ) as environment_mocks, patch.object(
+        training.s3_utils, "configure"
+    ) as configure:
+        environment_mocks["Environment"].return_value = single_machine_training_env
+        yield dict(training_mocks, configure=configure, **environment_mocks)
+
+
 def simple_training_env():
-    env = MagicMock()
-    env.module_dir = MODULE_DIR
-    env.user_entry_point = MODULE_NAME
-    env.hyperparameters = {"model_dir": MODEL_DIR}
-    env.log_level = LOG_LEVEL
-    env.additional_framework_parameters = {}
-    env.hosts = CURRENT_HOST
-    env.current_host = CURRENT_HOST
-    env.to_env_vars = lambda: {}
-    env.job_name = "test-training-job"
-    return env
+    return argparse.Namespace(
+        module_dir=MODULE_DIR,
+        user_entry_point=MODULE_NAME,
+        hyperparameters={"model_dir": MODEL_DIR},
+        log_level=LOG_LEVEL,
+        additional_framework_parameters={},
+        hosts=CURRENT_HOST,
+        current_host=CURRENT_HOST,
+        to_env_vars=lambda: {},
+        job_name="test-training-job",
+    )
 
 
 def test_is_host_master():
@@ -79,10 +126,9 @@ def test_is_host_master():
     assert training._is_host_master(HOST_LIST, "somehost") is False
 
 
-@patch("sagemaker_training.entry_point.run")
-def test_single_machine(run_module, single_machine_training_env):
+def test_single_machine(run, single_machine_training_env):
     training.train(single_machine_training_env, MODEL_DIR_CMD_LIST)
-    run_module.assert_called_with(
+    run.assert_called_with(
         uri=MODULE_DIR,
         user_entry_point=MODULE_NAME,
         args=MODEL_DIR_CMD_LIST,
@@ -92,12 +138,11 @@ def test_single_machine(run_module, single_machine_training_env):
     )
 
 
-@patch("sagemaker_training.entry_point.run")
-def test_train_horovod(run_module, single_machine_training_env):
+def test_train_horovod(run, single_machine_training_env):
     single_machine_training_env.additional_framework_parameters["sagemaker_mpi_enabled"] = True
 
     training.train(single_machine_training_env, MODEL_DIR_CMD_LIST)
-    run_module.assert_called_with(
+    run.assert_called_with(
         uri=MODULE_DIR,
         user_entry_point=MODULE_NAME,
         args=MODEL_DIR_CMD_LIST,
@@ -108,86 +153,63 @@ def test_train_horovod(run_module, single_machine_training_env):
 
 
 @pytest.mark.skip_on_pipeline
-@pytest.mark.skipif(
-    sys.version_info.major != 3, reason="Skip this for python 2 because of dict key order mismatch"
-)
-@patch("tensorflow.train.ClusterSpec")
-@patch("tensorflow.train.Server")
-@patch("sagemaker_training.entry_point.run")
-@patch("multiprocessing.Process", lambda target: target())
-@patch("time.sleep", MagicMock())
-def test_train_distributed_master(run, tf_server, cluster_spec, distributed_training_env):
-    training.train(distributed_training_env, MODEL_DIR_CMD_LIST)
-
-    cluster_spec.assert_called_with(
-        {"worker": ["host2:2222"], "master": ["host1:2222"], "ps": ["host1:2223", "host2:2223"]}
-    )
-
-    tf_server.assert_called_with(
-        cluster_spec(), job_name="ps", task_index=0, config=tf.ConfigProto(device_count={"GPU": 0})
-    )
-    tf_server().join.assert_called_with()
-
-    tf_config = (
-        '{"cluster": {'
-        '"master": ["host1:2222"], '
-        '"ps": ["host1:2223", "host2:2223"], '
-        '"worker": ["host2:2222"]}, '
-        '"environment": "cloud", '
-        '"task": {"index": 0, "type": "master"}}'
-    )
-
-    run.assert_called_with(
-        uri="s3://my/bucket",
-        user_entry_point="script_name",
-        args=MODEL_DIR_CMD_LIST,
-        env_vars={"TF_CONFIG": tf_config},
-        capture_error=True,
-    )
-
-
-@pytest.mark.skip_on_pipeline
-@pytest.mark.skipif(
-    sys.version_info.major != 3, reason="Skip this for python 2 because of dict key order mismatch"
+@pytest.mark.parametrize(
+    "current_host,ps_task_index,tf_config,check_calls",
+    [
+        (HOST1, 0, MASTER_TF_CONFIG, []),
+        (
+            HOST2,
+            1,
+            WORKER_TF_CONFIG,
+            [call(["curl", "host1:2222"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)],
+        ),
+    ],
+    ids=["master", "worker"],
 )
 @patch("tensorflow.train.ClusterSpec")
 @patch("tensorflow.train.Server")
-@patch("sagemaker_training.entry_point.run")
 @patch("multiprocessing.Process", lambda target: target())
-@patch("time.sleep", MagicMock())
-def test_train_distributed_worker(run, tf_server, cluster_spec, distributed_training_env):
-    distributed_training_env.current_host = HOST2
+@patch("subprocess.check_call", new_callable=Mock)
+def test_train_distributed(
+    check_call,
+    tf_server,
+    cluster_spec,
+    run,
+    distributed_training_env,
+    current_host,
+    ps_task_index,
+    tf_config,
+    check_calls,
+):
+    check_call.side_effect = subprocess.CalledProcessError(1, [])
+    distributed_training_env.current_host = current_host
 
     training.train(distributed_training_env, MODEL_DIR_CMD_LIST)
 
-    cluster_spec.assert_called_with(
-        {"worker": ["host2:2222"], "master": ["host1:2222"], "ps": ["host1:2223", "host2:2223"]}
-    )
+    cluster_spec.assert_called_with(dict(CLUSTER_WITH_PS))
 
     tf_server.assert_called_with(
-        cluster_spec(), job_name="ps", task_index=1, config=tf.ConfigProto(device_count={"GPU": 0})
+        cluster_spec(),
+        job_name="ps",
+        task_index=ps_task_index,
+        config=tf.ConfigProto(device_count={"GPU": 0}),
     )
     tf_server().join.assert_called_with()
 
-    tf_config = (
-        '{"cluster": {'
-        '"master": ["host1:2222"], '
-        '"ps": ["host1:2223", "host2:2223"], '
-        '"worker": ["host2:2222"]}, '
-        '"environment": "cloud", '
-        '"task": {"index": 0, "type": "worker"}}'
-    )
-
     run.assert_called_with(
         uri="s3://my/bucket",
         user_entry_point="script_name",
         args=MODEL_DIR_CMD_LIST,
-        env_vars={"TF_CONFIG": tf_config},
+        env_vars=ANY,
         capture_error=True,
     )
+    env_vars = run.call_args[1]["env_vars"]
+    assert list(env_vars) == ["TF_CONFIG"]
+    assert json.loads(env_vars["TF_CONFIG"]) == tf_config
+
+    assert check_call.call_args_list == check_calls
 
 
-@patch("sagemaker_training.entry_point.run")
 def test_train_distributed_no_ps(run, distributed_training_env):
     distributed_training_env.additional_framework_parameters[
         training.SAGEMAKER_PARAMETER_SERVER_ENABLED
@@ -205,26 +227,20 @@ def test_train_distributed_no_ps(run, distributed_training_env):
     )
 
 
-def test_build_tf_config():
-    assert training._build_tf_config(HOST_LIST, HOST1) == {
-        "cluster": CLUSTER_WITH_PS,
-        "environment": "cloud",
-        "task": MASTER_TASK,
-    }
-    assert training._build_tf_config(HOST_LIST, HOST1, ps_task=True) == {
-        "cluster": CLUSTER_WITH_PS,
-        "environment": "cloud",
-        "task": PS_TASK_1,
-    }
-    assert training._build_tf_config(HOST_LIST, HOST2) == {
-        "cluster": CLUSTER_WITH_PS,
-        "environment": "cloud",
-        "task": WORKER_TASK,
-    }
-    assert training._build_tf_config(HOST_LIST, HOST2, ps_task=True) == {
-        "cluster": CLUSTER_WITH_PS,
+@pytest.mark.parametrize(
+    "host,ps_task,expected_task",
+    [
+        (HOST1, False, MASTER_TASK),
+        (HOST1, True, PS_TASK_1),
+        (HOST2, False, WORKER_TASK),
+        (HOST2, True, PS_TASK_2),
+    ],
+)
+def test_build_tf_config(host, ps_task, expected_task):
+    assert training._build_tf_config(HOST_LIST, host, ps_task=ps_task) == {
+        "cluster": dict(CLUSTER_WITH_PS),
         "environment": "cloud",
-        "task": PS_TASK_2,
+        "task": expected_task,
     }
 
 
@@ -278,95 +294,39 @@ def test_log_model_missing_warning_correct(logger):
     logger.warn.assert_not_called()
 
 
-@patch("sagemaker_tensorflow_container.training.logger")
-@patch("sagemaker_tensorflow_container.training.train")
-@patch("logging.Logger.setLevel")
-@patch("sagemaker_training.environment.Environment")
-@patch("sagemaker_training.environment.read_hyperparameters", return_value={})
-@patch("sagemaker_tensorflow_container.s3_utils.configure")
-def test_main(
-    configure_s3_env,
-    read_hyperparameters,
-    training_env,
-    set_level,
-    train,
-    logger,
-    single_machine_training_env,
-):
-    training_env.return_value = single_machine_training_env
-    os.environ["SAGEMAKER_REGION"] = REGION
+def test_main(monkeypatch, main_mocks, single_machine_training_env):
+    main_mocks["read_hyperparameters"].return_value = {}
+    monkeypatch.setenv("SAGEMAKER_REGION", REGION)
     training.main()
-    read_hyperparameters.assert_called_once_with()
-    training_env.assert_called_once_with(hyperparameters={})
-    train.assert_called_once_with(single_machine_training_env, MODEL_DIR_CMD_LIST)
-    configure_s3_env.assert_called_once()
+    main_mocks["read_hyperparameters"].assert_called_once_with()
+    main_mocks["Environment"].assert_called_once_with(hyperparameters={})
+    main_mocks["train"].assert_called_once_with(single_machine_training_env, MODEL_DIR_CMD_LIST)
+    main_mocks["configure"].assert_called_once()
 
 
-@patch("sagemaker_tensorflow_container.training.logger")
-@patch("sagemaker_tensorflow_container.training.train")
-@patch("logging.Logger.setLevel")
-@patch("sagemaker_training.environment.Environment")
-@patch("sagemaker_training.environment.read_hyperparameters", return_value={"model_dir": MODEL_DIR})
-@patch("sagemaker_tensorflow_container.s3_utils.configure")
-def test_main_simple_training_model_dir(
-    configure_s3_env,
-    read_hyperparameters,
-    training_env,
-    set_level,
-    train,
-    logger,
-    single_machine_training_env,
-):
-    training_env.return_value = single_machine_training_env
-    os.environ["SAGEMAKER_REGION"] = REGION
+def test_main_simple_training_model_dir(monkeypatch, main_mocks):
+    main_mocks["read_hyperparameters"].return_value = {"model_dir": MODEL_DIR}
+    monkeypatch.setenv("SAGEMAKER_REGION", REGION)
     training.main()
-    configure_s3_env.assert_called_once_with(MODEL_DIR, REGION)
+    main_mocks["configure"].assert_called_once_with(MODEL_DIR, REGION)
 
 
-@patch("sagemaker_tensorflow_container.training.logger")
-@patch("sagemaker_tensorflow_container.training.train")
-@patch("logging.Logger.setLevel")
-@patch("sagemaker_training.environment.Environment")
-@patch(
-    "sagemaker_training.environment.read_hyperparameters",
-    return_value={"model_dir": MODEL_DIR, "_tuning_objective_metric": "auc"},
-)
-@patch("sagemaker_tensorflow_container.s3_utils.configure")
-def test_main_tuning_model_dir(
-    configure_s3_env,
-    read_hyperparameters,
-    training_env,
-    set_level,
-    train,
-    logger,
-    single_machine_training_env,
-):
-    training_env.return_value = single_machine_training_env
-    os.environ["SAGEMAKER_REGION"] = REGION
+def test_main_tuning_model_dir(monkeypatch, main_mocks, single_machine_training_env):
+    main_mocks["read_hyperparameters"].return_value = {
+        "model_dir": MODEL_DIR,
+        "_tuning_objective_metric": "auc",
+    }
+    monkeypatch.setenv("SAGEMAKER_REGION", REGION)
     training.main()
     expected_model_dir = "{}/{}/model".format(MODEL_DIR, single_machine_training_env.job_name)
-    configure_s3_env.assert_called_once_with(expected_model_dir, REGION)
+    main_mocks["configure"].assert_called_once_with(expected_model_dir, REGION)
 
 
-@patch("sagemaker_tensorflow_container.training.logger")
-@patch("sagemaker_tensorflow_container.training.train")
-@patch("logging.Logger.setLevel")
-@patch("sagemaker_training.environment.Environment")
-@patch(
-    "sagemaker_training.environment.read_hyperparameters",
-    return_value={"model_dir": "/opt/ml/model", "_tuning_objective_metric": "auc"},
-)
-@patch("sagemaker_tensorflow_container.s3_utils.configure")
-def test_main_tuning_mpi_model_dir(
-    configure_s3_env,
-    read_hyperparameters,
-    training_env,
-    set_level,
-    train,
-    logger,
-    single_machine_training_env,
-):
-    training_env.return_value = single_machine_training_env
-    os.environ["SAGEMAKER_REGION"] = REGION
+def test_main_tuning_mpi_model_dir(monkeypatch, main_mocks):
+    main_mocks["read_hyperparameters"].return_value = {
+        "model_dir": "/opt/ml/model",
+        "_tuning_objective_metric": "auc",
+    }
+    monkeypatch.setenv("SAGEMAKER_REGION", REGION)
     training.main()
-    configure_s3_env.assert_called_once_with("/opt/ml/model", REGION)
+    main_mocks["configure"].assert_called_once_with("/opt/ml/model", REGION)